@@ -1,12 +1,37 @@
 from yattag import Doc
 from yattag.simpledoc import SimpleDoc
-from typing import Literal, OrderedDict
+from typing import Literal
 from functools import wraps
 from pathlib import Path
 from inspect import getframeinfo, stack
+import threading
+
+
+def doc_attribute(name):
+    """
+    Property for the `doc`, `tag` and `text` components build their html with
+
+    User scripts for different visitors can run at the same time (in different threads) so each thread
+    gets its own doc, created on first use
+    """
+
+    def get(self):
+        if not hasattr(self._docs, name):
+            self._docs.doc, self._docs.tag, self._docs.text = Doc().tagtext()
+        return getattr(self._docs, name)
+
+    def set(self, value):
+        setattr(self._docs, name, value)
+
+    return property(get, set)
 
 
 class Components:
+    _docs = threading.local()
+    doc = doc_attribute("doc")
+    tag = doc_attribute("tag")
+    text = doc_attribute("text")
+
     def __init__(self) -> None:
         self.return_old_doc_and_init_new()
         # self.doc, self.tag, self.text = Doc().tagtext()
@@ -131,7 +156,7 @@ class Components:
         Returns:
             str: text inputted by user
         """
-        component_attr = self.get_components().get(key, OrderedDict())
+        component_attr = self.get_components().get(key, {})
         with self.tag("label"):
             self.text(label)
         with self.tag(
@@ -159,7 +184,7 @@ class Components:
         Returns:
             str: text inputted by user
         """
-        component_attr = self.get_components().get(key, OrderedDict())
+        component_attr = self.get_components().get(key, {})
         with self.tag("label"):
             self.text(label)
         with self.tag(
@@ -213,7 +238,7 @@ class Components:
             "maxValue": maxValue,
         }
 
-        component_attr = self.get_components().get(key, OrderedDict())
+        component_attr = self.get_components().get(key, {})
         component_key = key
         with self.tag(
             "input",
@@ -244,7 +269,7 @@ class Components:
         if not key:
             key = label
         kwargs = {}
-        component_attr = self.get_components().get(key, OrderedDict())
+        component_attr = self.get_components().get(key, {})
         component_value = component_attr.get("current_value", False)
         component_key = key
         with self.tag("ul"):
@@ -323,7 +348,7 @@ class Components:
         if not key:
             key = label
 
-        component_attr = self.get_components().get(key, OrderedDict())
+        component_attr = self.get_components().get(key, {})
         component_value = component_attr.get("current_value", default_value)
         component_key = key
         with self.tag("label", ("for", component_key)):
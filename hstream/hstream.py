@@ -1,16 +1,26 @@
-from random import randint
+import secrets
 from pathlib import Path
 import sys
-import builtins
 import shelve
+import asyncio
+import copy
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
+
+try:
+    import dbm.gnu as gdbm
+except ImportError:  # not every python is built with gdbm
+    gdbm = None
 from fastapi import FastAPI, Request
 from fastapi.responses import HTMLResponse, PlainTextResponse, Response
 from fastapi.templating import Jinja2Templates
-from typing import OrderedDict
+from collections import OrderedDict
 import os
+import json
 from yattag import Doc
 from .components import Components
-from .hstag import HsDoc, HS_HTML_CONSTANT
 from .hstag import HsDoc
 import click
 
@@ -37,21 +47,78 @@ import click
 
 templates = Jinja2Templates(Path(__file__).parent / "templates")
 
+# db path of the visitor the current request is for (see `get_app_db_path`), as a context variable
+# it follows the request into the thread the user's script runs in (see `run_user_script`)
+current_app_db_path = ContextVar("current_app_db_path")
+
+# headers for component types that don't render in place (i.e. the nav is swapped into the page's `nav`)
+RETARGET_HEADERS = {"Nav": {"HX-Retarget": "#hs-nav"}}
+# how many visitor dbs we keep open at once, least recently used ones are closed past this
+DB_CACHE_SIZE = 128
+# how many visitors' state we keep in memory, least recently used ones are written back and dropped past this
+USER_STATE_CACHE_SIZE = 1024
+# how often (in seconds) visitor state that changed in memory is written back to their db
+FLUSH_INTERVAL = 5
+
+
+def open_app_db(path):
+    """
+    Open a visitor's db as a shelf
+
+    We prefer gdbm opened in fast mode (writes are only synced when we call `sync`, which the
+    state flusher does) since the default `dbm` can end up as `dbm.dumb` which rewrites its index on every sync
+
+    Args:
+        path (str): path to the visitor's db
+
+    Returns:
+        shelve.Shelf: visitor's "db"
+    """
+    if gdbm is None:
+        return shelve.open(path, writeback=False)
+    return shelve.Shelf(gdbm.open(f"{path}.gdbm", "cf"), writeback=False)
+
 
 class Hyperstream(Components):
     def __init__(self):
-        self.app = FastAPI(debug=True, middleware=middleware)
+        # tracebacks are only sent to the browser when asked for (`HSTREAM_DEBUG=1`)
+        self.app = FastAPI(debug=os.environ.get("HSTREAM_DEBUG") == "1")
         self.path_to_user_script = Path(os.getcwd()) / Path(sys.argv[1])
         self.path_to_usesr_directory = Path(os.getcwd())
         self.path_to_app_db = Path(os.getcwd()) / "app_db"
+        # visitor dbs all live in `hs_data`, paths are kept as strings because `shelve` doesn't like paths
+        (self.path_to_usesr_directory / "hs_data").mkdir(exist_ok=True)
+        self.path_to_main_app_db = str(
+            self.path_to_usesr_directory / "hs_data" / "main.db"
+        )
         #
         # this is sctrictly for building html from within compoennts),
         # a tweaked version of Yattag is used for html creation from within user's scripts
         # see `hstag.py`
         self.doc, self.tag, self.text = Doc().tagtext()
 
+        # open shelves keyed by visitor db path (see `_db`), so we don't open/close the db on every call
+        self._db_cache = OrderedDict()
+        # visitor state (components and refresh queue) lives here keyed by db path, the components are
+        # written back to the visitor's db in the background (see `flush_user_state`)
+        self._user_state = OrderedDict()
+        # user scripts (and so `_state`/`_db`) run in other threads than the flusher, this guards the two caches above
+        self._cache_lock = threading.RLock()
+        # refresh queue versions are drawn from here so a version is never reused (even once a visitor's state is
+        # dropped and reloaded), `_boot_id` tells apart versions handed out before a restart
+        self._update_required_versions = itertools.count()
+        self._boot_id = secrets.token_hex(4)
         self._queue_user_script_rerun = True
+        # (script mtime, code object) of the last user script compile, see `compile_user_code`
+        self._compiled_user_code = None
+        # user scripts run in the threads of `_script_executor` (started with the app) so a slow script doesn't
+        # block the server, runs for the same visitor wait on the "script_lock" in their state while different
+        # visitors run side by side
         # on init we start fresh
+        # without touching the db: we can be running in uvicorn's reloader process which never starts or shuts down
+        # the app, anything opened here would stay open (and with gdbm keep the db locked for the worker that
+        # actually serves the app), the cleared state is written by the worker's flusher
+        self._state(load=False)
         self.clear_components()
         self.clear_component_refresh_queue(all_component=True)
         self.stylesheet_href = "https://unpkg.com/mvp.css@1.12/mvp.css"
@@ -64,9 +131,33 @@ class Hyperstream(Components):
         """
         self.build_fastapi_app()
 
+        @self.app.on_event("startup")
+        async def start_workers():
+            self._script_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+            self._user_state_flusher = asyncio.create_task(
+                self._flush_user_state_periodically()
+            )
+
+        @self.app.on_event("shutdown")
+        def close_app_dbs():
+            self._user_state_flusher.cancel()
+            self._script_executor.shutdown()
+            self.flush_user_state()
+            with self._cache_lock:
+                while self._db_cache:
+                    _, app_db = self._db_cache.popitem()
+                    app_db.close()
+
         @self.app.get("/update")
         async def should_components_update(request: Request, response: Response):
-            components = self.get_component_refresh_queue()
+            state = self._state()
+            # the visitor's browser sends back the ETag of its last poll, if the refresh queue didn't change since
+            # there is nothing new to tell it
+            etag = f'"{self._boot_id}-{state["update_required_version"]}"'
+            if request.headers.get("If-None-Match") == etag:
+                return Response(status_code=304, headers={"ETag": etag})
+
+            components = state["update_required"]
             # see if we need to do a full refresh (usually if content is generated inside a conditional value based on hs)
             if "_full_page" in components:
                 response.headers["HX-Refresh"] = "true"
@@ -75,9 +166,18 @@ class Hyperstream(Components):
             else:
                 # htmx expect multiple triggers in JSON format - see: https://github.com/bigskysoftware/htmx/issues/1030
                 # final form should be {"mycomponentkeyEven":"", "mysecondcomponentkeyEven":""}
-                import json
-
-                response.headers["HX-Trigger"] = json.dumps({c: "" for c in components})
+                # (`json` escapes non ascii keys, header values have to be latin-1)
+                # polls in between refresh queue changes get the same triggers so we only encode them once per change
+                version = state["update_required_version"]
+                if not state["update_trigger"] or state["update_trigger"][0] != version:
+                    state["update_trigger"] = (
+                        version,
+                        json.dumps({c: "" for c in components}) if components else "{}",
+                    )
+                response.headers["HX-Trigger"] = state["update_trigger"][1]
+                response.headers["ETag"] = etag
+                # the browser has to check back with us (`If-None-Match`) before reusing a poll response
+                response.headers["Cache-Control"] = "no-cache"
                 # gotcha here is that fastapi transforms any "_" to a "-" in the header values
                 return str(response.headers["HX-Trigger"])
 
@@ -90,25 +190,20 @@ class Hyperstream(Components):
             response = Response("Internal server error", status_code=500)
             hs_user_id = request.cookies.get("hs_user_id", False)
             if not hs_user_id:
-                hs_user_id = str(randint(100000, 1000000))
-                context.hs_user_app_db_path = (
-                    self.path_to_usesr_directory / "hs_data" / str(hs_user_id)
-                )
-            else:
-                context.hs_user_app_db_path = (
-                    self.path_to_usesr_directory / "hs_data" / str(hs_user_id)
-                )
-            if request.url.path == "/":
-                # assert context.hs_user_app_db_path
-                # if this is the first request we clean all state
-                self.clear_components()
-                self.clear_component_refresh_queue(all_component=True)
-                self.run_user_script()
+                hs_user_id = secrets.token_urlsafe(9)
+            current_app_db_path.set(
+                str(self.path_to_usesr_directory / "hs_data" / hs_user_id)
+            )
+            async with self._state()["script_lock"]:
+                if request.url.path == "/":
+                    # if this is the first request we clean all state
+                    self.clear_components()
+                    self.clear_component_refresh_queue(all_component=True)
+                    await self.run_user_script(self._state())
 
-            elif self._queue_user_script_rerun:
-                self.run_user_script()
+                elif self._queue_user_script_rerun:
+                    await self.run_user_script(self._state())
 
-            assert context.hs_user_app_db_path
             response = await call_next(request)
 
             response.set_cookie("hs_user_id", hs_user_id)
@@ -118,76 +213,170 @@ class Hyperstream(Components):
 
     def html(self, *args, **kwargs):
         doc, tag, text = HsDoc().tagtext()
-        kwargs["path_to_app_db"] = path_to_app_db = self.get_app_db_path()
+        # tags are written to the components through us so they share the visitor's open db
+        kwargs["app_db"] = self
         return tag(*args, **kwargs)
 
     def get_app_db_path(self):
         """
         Get the app path regardless if we're getting from the user's code or from fastapi
 
-        * Gotcha * we need either a
-        - valid context from `starlette_context` or
-        - monkeypatched `builtin` with a global variable defined as hs_user_app_db_path (see `run_user_script` with `builtins` patch for info)
-
+        * Gotcha * this relies on `current_app_db_path` which is set per request and carried into the user's script
+        (see `run_user_script`), outside of a request (i.e. on startup) there is no visitor and we fall back to a common db
 
         Returns:
             str: path to user "db"
         """
+        # set by `evaluate_user_code_middleware` on request based on user cookie
+        # for run's without a user (I think this just happen on the first run)
+        # there is no cookie and we just fail gracefully to a common db
+        # this might not be nessecary and could maybe just go to /dev/null
+        return current_app_db_path.get(self.path_to_main_app_db)
 
-        if getattr(builtins, "hs_user_app_db_path", False):
-            # running from inside user script and using the weirdly set builtins user_id
-            path = Path(self.path_to_usesr_directory / "hs_data" / hs_user_app_db_path)
+    def _db(self, path=None):
+        """
+        Get the open shelf for a visitor (the current one by default), opening it on first use
 
-        else:
-            # running from inside fastapi and using the user's context
-            path = Path(
-                getattr(
-                    context,  # uses FastAPI's request wide context
-                    "hs_user_app_db_path",  # get the hs_user_app_db_path attribute set on request based on user cookie
-                    # for run's without a user (I think this just happen on the first run)
-                    # there is no cookie and we just fail gracefully to a common db
-                    # this might not be nessecary and could maybe just go to /dev/null
-                    self.path_to_usesr_directory / "hs_data" / "main.db",
-                )
-            )
-            path.parent.mkdir(exist_ok=True)
-        return str(path)  # we cast this to string because `shelve` doesn't like paths
+        Shelves are kept open (up to `DB_CACHE_SIZE`, least recently used are closed first)
+        and closed on shutdown
+
+        Args:
+            path (str, optional): db path of the visitor. Defaults to the current visitor's.
+
+        Returns:
+            shelve.Shelf: visitor's "db"
+        """
+        path = path or self.get_app_db_path()
+        with self._cache_lock:
+            app_db = self._db_cache.get(path)
+            if app_db is None:
+                app_db = self._db_cache[path] = open_app_db(path)
+                if len(self._db_cache) > DB_CACHE_SIZE:
+                    _, least_recently_used = self._db_cache.popitem(last=False)
+                    least_recently_used.close()
+            else:
+                self._db_cache.move_to_end(path)
+            return app_db
+
+    def _state(self, load=True):
+        """
+        Get the current visitor's in memory state, loading it from their db on first use
+
+        Anything changing the components needs to bump the "version" so they get written back to the db
+        (see `_write_state`), reads never touch the db once the state is loaded.
+        The refresh queue ("update_required") is never written to the db, it only matters while the visitor
+        has the page open and a fresh load of `/` clears it anyway. Changes to it take a new
+        "update_required_version" (unique across visitors, see `_update_required_versions`) so `/update` knows
+        when its last "update_trigger" (version, HX-Trigger header) is out of date and can tell the visitor's
+        browser if nothing changed since its last poll (ETag)
+
+        Args:
+            load (bool, optional): load the state from the visitor's db on first use, otherwise it starts blank.
+                Defaults to True.
+
+        Returns:
+            dict: {"components": dict, "update_required": set, "update_required_version": int,
+                   "update_trigger": tuple | None, "version": int, "flushed_version": int,
+                   "script_lock": asyncio.Lock}
+        """
+        path = self.get_app_db_path()
+        with self._cache_lock:
+            state = self._user_state.get(path)
+            if state is None:
+                app_db = self._db(path) if load else {}
+                state = self._user_state[path] = {
+                    # dbs written before we moved to plain dicts hold an `OrderedDict`
+                    "components": dict(app_db.get("components", {})),
+                    "update_required": set(),
+                    "update_required_version": next(self._update_required_versions),
+                    "update_trigger": None,
+                    "version": 0,
+                    "flushed_version": 0,
+                    # held while the user's script runs for this visitor (see `evaluate_user_code_middleware`)
+                    "script_lock": asyncio.Lock(),
+                }
+                if len(self._user_state) > USER_STATE_CACHE_SIZE:
+                    # a visitor whose script is running still uses their state, dropping it would let their next
+                    # run start on a fresh state (and lock) next to the current one, so we drop the least recently
+                    # used visitor that is idle (if all are busy we're over the limit until the next new visitor)
+                    idle_path = next(
+                        (
+                            lru_path
+                            for lru_path, lru_state in self._user_state.items()
+                            if lru_path != path
+                            and not lru_state["script_lock"].locked()
+                        ),
+                        None,
+                    )
+                    if idle_path is not None:
+                        self._write_state(idle_path, self._user_state.pop(idle_path))
+            else:
+                self._user_state.move_to_end(path)
+            return state
+
+    def _write_state(self, path, state):
+        """Write the visitor's components to their db if they changed since they were last written"""
+        with self._cache_lock:
+            version = state["version"]
+            if version != state["flushed_version"]:
+                # a visitor's state that can't be written (i.e. a component value that doesn't pickle) must not stop
+                # the others from being written, it stays unflushed and is tried again on the next flush
+                try:
+                    app_db = self._db(path)
+                    app_db["components"] = state["components"]
+                    app_db.sync()
+                except Exception as e:
+                    print("error writing visitor state", path, e)
+                    return
+                # anything changed while writing has a newer version and will be written next time
+                state["flushed_version"] = version
+
+    def flush_user_state(self):
+        """Write the state of the visitors that changed since the last flush to their db"""
+        with self._cache_lock:
+            for path, state in list(self._user_state.items()):
+                self._write_state(path, state)
+
+    async def _flush_user_state_periodically(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            # pickling and syncing the dbs blocks, so like the user's scripts it runs off the event loop
+            await loop.run_in_executor(None, self.flush_user_state)
 
     def get_components(
         self,
     ):
-        with shelve.open(self.get_app_db_path()) as app_db:
-            return app_db.get("components", OrderedDict())
+        return self._state()["components"]
 
     def write_components(
         self,
         components,
     ):
-        with shelve.open(self.get_app_db_path()) as app_db:
-            app_db["components"] = components
+        state = self._state()
+        state["components"] = components
+        state["version"] += 1
 
     def clear_components(self):
-        with shelve.open(self.get_app_db_path()) as app_db:
-            app_db["components"] = OrderedDict()
+        state = self._state()
+        state["components"] = {}
+        state["version"] += 1
 
     def schedule_component_refresh(self, component_name):
-        with shelve.open(self.get_app_db_path()) as app_db:
-            app_db["update_required"] = app_db.get("update_required", set()).union(
-                set([component_name])
-            )
+        state = self._state()
+        state["update_required"].add(component_name)
+        state["update_required_version"] = next(self._update_required_versions)
 
     def clear_component_refresh_queue(self, component=None, all_component=False):
-        with shelve.open(self.get_app_db_path()) as app_db:
-            if all_component:
-                app_db["update_required"] = set()
-            else:
-                updates_required = app_db.get("update_required", set())
-                updates_required.discard(component)
-                app_db["update_required"] = updates_required
+        state = self._state()
+        if all_component:
+            state["update_required"] = set()
+        else:
+            state["update_required"].discard(component)
+        state["update_required_version"] = next(self._update_required_versions)
 
     def get_component_refresh_queue(self):
-        with shelve.open(self.get_app_db_path()) as app_db:
-            return app_db.get("update_required", set())
+        return self._state()["update_required"]
 
     def build_fastapi_app(self):
         # Add main html to app
@@ -196,7 +385,7 @@ class Hyperstream(Components):
             request: Request,
             response: Response,
         ):
-            assert context.hs_user_app_db_path
+            assert current_app_db_path.get(False)
             #
             # since we're starting with a blank page we won't need  a full page reload
             # if this isn't set we get full reload requests from the first user script run (because there are delta's)
@@ -218,22 +407,22 @@ class Hyperstream(Components):
             component_key, request: Request, response: Response
         ):
             # lets remove this from our refresh queue as we're processing it
-            assert getattr(context, "hs_user_app_db_path", False)
-            component_attr = self.get_components()[component_key]
-            self.clear_component_refresh_queue(
-                component=component_attr["component_key"]
-            )
+            assert current_app_db_path.get(False)
+            state = self._state()
+            component_attr = state["components"][component_key]
+            if component_attr["component_key"] in state["update_required"]:
+                self.clear_component_refresh_queue(
+                    component=component_attr["component_key"]
+                )
             # Make sure we have the required attributes before passing to Jinja avoids ambigious HTML bugs
             assert component_attr.get("component_key", False) and component_attr.get(
                 "label", False
             )
 
-            if component_attr["component_type"] == "Nav":
-                headers = {"HX-Retarget": "#hs-nav"}
-            else:
-                headers = {}
-
-            return HTMLResponse(component_attr["label"], headers=headers)
+            return HTMLResponse(
+                component_attr["label"],
+                headers=RETARGET_HEADERS.get(component_attr["component_type"]),
+            )
 
         @self.app.post("/value_changed/{component_key}")
         async def func_for_component_value_changed(component_key, request: Request):
@@ -247,18 +436,11 @@ class Hyperstream(Components):
                 _type_: _description_
             """
             components = self.get_components()
-            form_values = await request.form()
-
-            component_value_from_form = form_values.get(component_key, False)
-            component_value_from_query_params = request.query_params.get(
-                component_key, False
-            )
-            assert component_value_from_form or component_value_from_query_params
-            component_value = (
-                component_value_from_form
-                if component_value_from_form
-                else component_value_from_query_params
-            )
+            # components like `nav` send their value in the query params, we only parse the body when they don't
+            component_value = request.query_params.get(component_key)
+            if not component_value:
+                component_value = (await request.form()).get(component_key)
+            assert component_value
             components[component_key]["current_value"] = component_value
             self.write_components(
                 components,
@@ -275,101 +457,91 @@ class Hyperstream(Components):
     def compile_user_code(self):
         self._queue_user_script_rerun = False
         source_path = self.path_to_user_script
-        with open(source_path) as f:
-            filebody = f.read()
-
-        # Start: funky stuff #TODO fix
-        # GOTCHA: we do some funky stuff here
-        # to get the user db path (based on user_id stored in cookie and set as context in FastAPI land) through user space
-        # we add a line at the top of the users' code to monkeypatch `hs_user_app_db_path` globally as the current visotors
-        # db path
-        filebody = f"import builtins \n" + filebody
-        filebody = (
-            f"""builtins.hs_user_app_db_path = "{getattr(context, 'hs_user_app_db_path', 'error')}" \n"""
-            + filebody
-        )
-
-        # End: funky stuff
-
-        code = compile(
-            filebody,
-            source_path,
-            mode="exec",
-            # Don't inherit any flags or "future" statements.
-            flags=0,
-            dont_inherit=1,
-            # Use the default optimization options.
-            optimize=-1,
-        )
+        # we only read and compile the user's script again if it changed
+        mtime = os.stat(source_path).st_mtime_ns
+        if self._compiled_user_code and self._compiled_user_code[0] == mtime:
+            code = self._compiled_user_code[1]
+        else:
+            with open(source_path) as f:
+                filebody = f.read()
+
+            code = compile(
+                filebody,
+                source_path,
+                mode="exec",
+                # Don't inherit any flags or "future" statements.
+                flags=0,
+                dont_inherit=1,
+                # Use the default optimization options.
+                optimize=-1,
+            )
+            self._compiled_user_code = (mtime, code)
         exec(
             code,
         )
 
-    def run_user_script(self):
-        assert (
-            context.hs_user_app_db_path
-        )  # we always need the visitor's path before we execute the script so we know where to store the visitors components
+    async def run_user_script(self, state):
+        """
+        Rerun the user's script and queue refreshes for whatever changed
+
+        Args:
+            state (dict): the visitor's in memory state (see `_state`), read and written directly for the whole run
+        """
+        # we always need the visitor's path before we execute the script so we know where to store the visitors components
+        assert current_app_db_path.get(False)
 
         # We do a delta here to if
         # 1) new elements have been added / page layout has changed -> the whole page needs to reload
         # 2) components display's have changed (i.e. a `write` has a new value) -> just that component needs a refresh
-        compoennts_before_user_run = self.get_components()
-        self.compile_user_code()
-        proposed_components_state = self.get_components()
-        self.write_components(self.get_components())
-
         # START: Annoying section #TODO fix this
         # because we're just writing html components into the components dict the delta generator below gets confused and we
         # first need to strip them out - or the page does a full reload every `/update`
-        compoennts_before_user_run = dict(
-            filter(
-                lambda component: HS_HTML_CONSTANT not in component[0],
-                compoennts_before_user_run.items(),
-            )
-        )
-
-        proposed_components_state = dict(
-            filter(
-                lambda component: HS_HTML_CONSTANT not in component[0],
-                proposed_components_state.items(),
-            )
+        # (html from `hstag` is stored as the raw tag string while components are dicts of their attributes)
+        # the user's script updates the components in place so we hold on to a copy of them as they were
+        compoennts_before_user_run = {
+            key: copy.deepcopy(attr)
+            for key, attr in state["components"].items()
+            if isinstance(attr, dict)
+        }
+        # the script runs in a copy of our context so it still knows which visitor it's running for
+        await asyncio.get_running_loop().run_in_executor(
+            self._script_executor, copy_context().run, self.compile_user_code
         )
+        proposed_components_state = {
+            key: attr
+            for key, attr in state["components"].items()
+            if isinstance(attr, dict)
+        }
         # END: Annoying section
 
+        if compoennts_before_user_run == proposed_components_state:
+            # nothing the visitor can see changed so there is nothing to refresh
+            if "_full_page" in state["update_required"]:
+                self.clear_component_refresh_queue(component="_full_page")
+            return
+
+        updates_required = state["update_required"]
         if not compoennts_before_user_run.keys() == proposed_components_state.keys():
-            self.schedule_component_refresh("_full_page")
+            updates_required.add("_full_page")
 
         else:
-            self.clear_component_refresh_queue(component="_full_page")
+            updates_required.discard("_full_page")
+            components_to_refresh = set()
             for key_before, attr_before in compoennts_before_user_run.items():
                 attr_next = proposed_components_state[key_before]
                 # we don't want the compoennt to refresh if the user has change the value
                 # (html should reflect this change on teh frontend already)
-                component_attr_to_trackchanges = filter(
-                    lambda attr: attr not in ["current_value"], attr_before
-                )
-                for attr_to_track in component_attr_to_trackchanges:
+                for attr_to_track in attr_before.keys() - {"current_value"}:
                     if not attr_before[attr_to_track] == attr_next[attr_to_track]:
-                        self.schedule_component_refresh(key_before)
+                        components_to_refresh.add(key_before)
+                        break
+            updates_required |= components_to_refresh
+
+        state["update_required_version"] = next(self._update_required_versions)
 
 
 from starlette.requests import Request
 from starlette.responses import JSONResponse
-from starlette.middleware import Middleware
-
-from starlette_context import context, plugins
-from starlette_context.middleware import RawContextMiddleware
-
-
-middleware = [
-    Middleware(
-        RawContextMiddleware,
-        plugins=(
-            plugins.RequestIdPlugin(),
-            plugins.CorrelationIdPlugin(),
-        ),
-    )
-]
 
 hs = Hyperstream()
 
@@ -29,8 +29,8 @@ setup(
         "Jinja2~=3.1",
         "Markdown~=3.4",
         "yattag~=1.14",
-        "starlette_context==0.3.4",
         "python-multipart",
+        "uvloop~=0.17; sys_platform != 'win32'",
     ],
     entry_points={"console_scripts": ["hstream = hyperstream.runner:run"]},
     packages=["hstream"],